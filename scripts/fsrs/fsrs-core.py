@@ -9,7 +9,10 @@ The DSR model tracks three memory variables:
   - Retrievability (R): current probability of successful recall (0.0 - 1.0)
 """
 
+import bisect
+import heapq
 import math
+from collections import Counter, OrderedDict
 from datetime import datetime, timedelta, timezone
 from enum import IntEnum
 from typing import Optional
@@ -39,6 +42,12 @@ DEFAULT_W = [
 FACTOR = 19.0 / 81.0  # ~0.2346
 DECAY = -0.5
 
+# Review queue orderings (relearning cards always come first)
+QUEUE_ORDERS = ("overdue", "retrievability", "difficulty")
+
+# Width of the log-stability bins retention_workload() simulates over
+WORKLOAD_STABILITY_STEP = 0.35
+
 
 class Rating(IntEnum):
     Again = 1
@@ -106,9 +115,10 @@ class ReviewLog:
         self.elapsed_days = elapsed_days
         self.scheduled_days = scheduled_days
         self.review_date = review_date
+        self.short_term = False  # stability came from short_term_stability()
 
     def to_dict(self):
-        return {
+        d = {
             "rating": self.rating,
             "state_before": self.state_before,
             "state_after": self.state_after,
@@ -116,6 +126,182 @@ class ReviewLog:
             "scheduled_days": self.scheduled_days,
             "review_date": self.review_date,
         }
+        if self.short_term:
+            d["short_term"] = True
+        return d
+
+
+class RetrievabilityIndex:
+    """Threshold-crossing index over a deck.
+
+    Keeps each card's last review and stability; for a threshold x the time
+    at which R drops to x is last_review + S * c(x), so cards sorted by that
+    crossing time answer "which concepts fall below x by date D" with a
+    binary search. The sorted array for a threshold costs O(n log n) once and
+    is cached, so the index pays off when it is kept across queries (as
+    fsrs-server.py does); a one-off query is no faster than a scan. Only the
+    most recently used thresholds keep their arrays."""
+
+    MAX_THRESHOLDS = 8
+
+    def __init__(self, fsrs, cards):
+        self.fsrs = fsrs
+        self._entries = []  # (concept_id, last_review in epoch days, stability)
+        for concept_id, card_data in cards.items():
+            card = Card.from_dict(card_data) if isinstance(card_data, dict) else card_data
+            if card.state == State.New or not card.last_review or card.stability <= 0:
+                continue
+            self._entries.append((concept_id, self._epoch_days(card.last_review), card.stability))
+        self._crossings = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def below(self, threshold, by=None):
+        """Cards whose retrievability is below threshold at `by` (default now),
+        soonest crossing first."""
+        if not 0.0 < threshold < 1.0:
+            raise ValueError("threshold must be between 0 and 1 (exclusive)")
+        times, order = self._sorted(threshold)
+        end = bisect.bisect_right(times, self._epoch_days(by))
+        return [self._describe(order[i], by, times[i]) for i in range(end)]
+
+    def weakest(self, k, at=None):
+        """The k cards with the lowest retrievability at `at` (default now)."""
+        t = self._epoch_days(at)
+        # R is monotone in elapsed / stability, so rank on that instead of R itself
+        top = heapq.nlargest(k, range(len(self._entries)),
+                             key=lambda i: (t - self._entries[i][1]) / self._entries[i][2])
+        return [self._describe(i, at) for i in top]
+
+    def _sorted(self, threshold):
+        if threshold in self._crossings:
+            self._crossings.move_to_end(threshold)
+            return self._crossings[threshold]
+        c = self.fsrs.time_to_retrievability(1.0, threshold)
+        pairs = sorted((lr + s * c, i) for i, (_, lr, s) in enumerate(self._entries))
+        self._crossings[threshold] = ([p[0] for p in pairs], [p[1] for p in pairs])
+        if len(self._crossings) > self.MAX_THRESHOLDS:
+            self._crossings.popitem(last=False)
+        return self._crossings[threshold]
+
+    def _describe(self, i, at, crossing=None):
+        concept_id, last_review, stability = self._entries[i]
+        elapsed = max(0.0, self._epoch_days(at) - last_review)
+        result = {
+            "concept_id": concept_id,
+            "retrievability": round(self.fsrs.retrievability(elapsed, stability), 4),
+            "stability": round(stability, 2),
+        }
+        if crossing is not None:
+            result["crosses_at"] = datetime.fromtimestamp(crossing * 86400.0, timezone.utc).isoformat()
+        return result
+
+    def _epoch_days(self, iso_date):
+        if iso_date is None:
+            dt = datetime.now(timezone.utc)
+        else:
+            dt = datetime.fromisoformat(iso_date.replace("Z", "+00:00"))
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+        return dt.timestamp() / 86400.0
+
+
+class ShortTermSession:
+    """In-session scheduler for learning and relearning steps.
+
+    Cards waiting to be re-shown sit in a heap keyed by re-show time, so the
+    next card is always an O(log n) pop. Answers go through
+    FSRS.review_short_term, so same-day repeats of Learning/Relearning cards
+    use the short-term weights w17/w18. Cards that stay in a step are re-shown
+    after minutes: Again waits steps[0]. Past the first answer, FSRS.review
+    graduates everything but Again, so the only other wait is a New card
+    answered Hard, which waits halfway to learning_steps[1]. Relearning
+    therefore takes a single step."""
+
+    def __init__(self, fsrs, learning_steps=(1, 10), relearning_steps=(10,)):
+        if not 1 <= len(learning_steps) <= 2 or any(step <= 0 for step in learning_steps):
+            raise ValueError("learning_steps must be one or two positive minute values")
+        if len(relearning_steps) != 1 or relearning_steps[0] <= 0:
+            raise ValueError("relearning_steps must be one positive minute value")
+        self.fsrs = fsrs
+        self.learning_steps = list(learning_steps)
+        self.relearning_steps = list(relearning_steps)
+        self.cards = {}
+        self._heap = []  # (show_at, seq, concept_id)
+        self._seq = 0
+        self._queued = set()
+        self._in_flight = set()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, concept_id, card, show_at=None):
+        """Queue a card (Card or card dict) to be shown at show_at (default now)."""
+        if concept_id in self._queued or concept_id in self._in_flight:
+            raise ValueError(f"{concept_id} is already in the session")
+        self.cards[concept_id] = Card.from_dict(card) if isinstance(card, dict) else card
+        self._push(concept_id, self._parse(show_at))
+
+    def peek(self):
+        """(concept_id, show_at) of the next card without removing it, or None."""
+        if not self._heap:
+            return None
+        show_at, _, concept_id = self._heap[0]
+        return concept_id, show_at.isoformat()
+
+    def next(self, now=None):
+        """Pop the card with the earliest re-show time as (concept_id, card, show_at).
+        If now is given, only a card due by then is returned. None when nothing is."""
+        if not self._heap:
+            return None
+        if now is not None and self._heap[0][0] > self._parse(now):
+            return None
+        show_at, _, concept_id = heapq.heappop(self._heap)
+        self._queued.discard(concept_id)
+        self._in_flight.add(concept_id)
+        return concept_id, self.cards[concept_id], show_at.isoformat()
+
+    def answer(self, concept_id, rating, review_date=None, card=None):
+        """Grade a card taken from next(). Pass card when it may have been
+        reviewed outside the session since it was added. Returns
+        (card, log, show_at); show_at is None once the card has left the session."""
+        if concept_id not in self._in_flight:
+            raise ValueError(f"{concept_id} was not taken from next()")
+        now = self._parse(review_date)
+        if card is None:
+            card = self.cards[concept_id]
+        elif isinstance(card, dict):
+            card = Card.from_dict(card)
+        new_card, log = self.fsrs.review_short_term(card, rating, now.isoformat())
+        self._in_flight.discard(concept_id)
+
+        self.cards[concept_id] = new_card
+        if new_card.state not in (State.Learning, State.Relearning):
+            return new_card, log, None
+
+        steps = self.relearning_steps if new_card.state == State.Relearning else self.learning_steps
+        if rating == Rating.Again:
+            delay = steps[0]
+        elif len(steps) > 1:
+            delay = (steps[0] + steps[1]) / 2.0
+        else:
+            delay = steps[0] * 1.5
+        show_at = now + timedelta(minutes=delay)
+        new_card.due = show_at.isoformat()
+        self._push(concept_id, show_at)
+        return new_card, log, new_card.due
+
+    def _push(self, concept_id, show_at):
+        self._queued.add(concept_id)
+        self._seq += 1
+        heapq.heappush(self._heap, (show_at, self._seq, concept_id))
+
+    def _parse(self, iso_date):
+        if iso_date is None:
+            return datetime.now(timezone.utc)
+        dt = datetime.fromisoformat(iso_date.replace("Z", "+00:00"))
+        return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
 
 
 class FSRS:
@@ -135,6 +321,10 @@ class FSRS:
             return 0.0
         return (1.0 + FACTOR * elapsed_days / stability) ** DECAY
 
+    def time_to_retrievability(self, stability, r):
+        """Inverse forgetting curve: days t at which R(t, S) falls to r."""
+        return (stability / FACTOR) * (r ** (1.0 / DECAY) - 1.0)
+
     def interval(self, stability):
         """Compute interval in days for desired retention."""
         i = (stability / FACTOR) * (self.desired_retention ** (1.0 / DECAY) - 1.0)
@@ -168,6 +358,11 @@ class FSRS:
         new_s = self.w[11] * d_f * s_f * r_f
         return min(new_s, s)
 
+    def short_term_stability(self, s, rating):
+        """Same-day stability update: S' = S * exp(w17 * (G - 3 + w18)).
+        Only review_short_term() uses it; review() keeps the FSRS-5 behaviour."""
+        return s * math.exp(self.w[17] * (rating - 3.0 + self.w[18]))
+
     def next_difficulty(self, d, rating):
         """Difficulty update with mean reversion toward D_0(Easy)."""
         delta = -self.w[6] * (rating - 3.0)
@@ -289,13 +484,203 @@ class FSRS:
             }
         return results
 
-    def get_queue(self, cards, today=None):
+    def review_short_term(self, card, rating, review_date=None):
+        """review(), except that a same-day repeat of a Learning/Relearning
+        card takes its stability from short_term_stability(). Such logs are
+        marked short_term so reschedule() replays them the same way."""
+        new_card, log = self.review(card, rating, review_date)
+        same_day_step = card.state in (State.Learning, State.Relearning) and log.elapsed_days == 0
+        if same_day_step and card.stability > 0:
+            new_card.stability = self.short_term_stability(card.stability, rating)
+            if new_card.state == State.Review:
+                interval = self.interval(new_card.stability)
+                new_card.scheduled_days = interval
+                new_card.due = self._add_days(log.review_date, interval)
+                log.scheduled_days = interval
+            log.short_term = True
+        return new_card, log
+
+    def reschedule(self, card, logs=None):
+        """Recompute a card under this scheduler's parameters.
+        When logs (ReviewLog dicts, oldest first) cover the card's whole
+        history, they are replayed from a new card. Otherwise a Review card
+        keeps its memory state and only its interval is recomputed from
+        stability. Returns (card, logs, replayed)."""
+        if self._logs_match(card, logs):
+            new_card = Card()
+            new_logs = []
+            for entry in logs:
+                review = self.review_short_term if entry.get("short_term") else self.review
+                new_card, log = review(new_card, entry["rating"], entry["review_date"])
+                new_logs.append(log.to_dict())
+            return new_card, new_logs, True
+
+        new_card = Card.from_dict(card.to_dict())
+        if card.state == State.Review and card.last_review and card.stability > 0:
+            interval = self.interval(card.stability)
+            new_card.scheduled_days = interval
+            new_card.due = self._add_days(card.last_review, interval)
+        return new_card, logs, False
+
+    def _logs_match(self, card, logs):
+        # Reviews made outside the log (e.g. by session-close) leave it stale;
+        # replaying a stale log would roll the card back
+        return bool(logs) and len(logs) == card.reps and logs[-1].get("review_date") == card.last_review
+
+    def retention_workload(self, cards, retentions, horizon=365, recall_cost=7.0, forget_cost=23.0, today=None):
+        """Expected review workload per unit of memorized knowledge for each
+        candidate desired retention, over a dict of {concept_id: card_dict}.
+
+        Cards are bucketed once by (log-stability, difficulty, days since last
+        review) and the deck is simulated as a distribution over stability
+        bins, day by day from `today`: every review costs recall_cost or
+        forget_cost seconds by its recall probability and splits the cards
+        into a success and a lapse branch, so lapsed cards pay for their
+        shorter intervals afterwards. Each review inside `horizon` is credited
+        with the knowledge (integral of R) of the interval it schedules, so
+        reviews deferred past the horizon are not counted as free."""
+        if today is None:
+            as_of = datetime.now(timezone.utc)
+        else:
+            as_of = datetime.fromisoformat(today.replace("Z", "+00:00"))
+            if as_of.tzinfo is None:
+                as_of = as_of.replace(tzinfo=timezone.utc)
+
+        buckets = Counter()
+        for card_data in cards.values():
+            card = Card.from_dict(card_data) if isinstance(card_data, dict) else card_data
+            if card.state == State.New or card.stability <= 0:
+                continue
+            elapsed = 0.0
+            if card.last_review:
+                last_review = datetime.fromisoformat(card.last_review.replace("Z", "+00:00"))
+                elapsed = max(0.0, (as_of - last_review).total_seconds() / 86400.0)
+            key = (
+                round(math.log(card.stability) / WORKLOAD_STABILITY_STEP),
+                round(card.difficulty * 2),
+                round(math.log1p(elapsed) * 2),
+            )
+            buckets[key] += 1
+
+        overdue = {}  # bucket -> outcomes of a review today, the same for every retention
+        results = []
+        for r in retentions:
+            total_cost, total_knowledge = self._simulate_workload(
+                buckets, overdue, r, horizon, recall_cost, forget_cost
+            )
+            results.append({
+                "retention": r,
+                "cost_per_day_sec": round(total_cost / horizon, 2),
+                "memorized": round(total_knowledge / horizon, 2),
+                "cost_per_memorized": round(total_cost / total_knowledge, 5) if total_knowledge > 0 else None,
+            })
+        return results
+
+    def _simulate_workload(self, buckets, overdue, r, horizon, recall_cost, forget_cost):
+        c = self.time_to_retrievability(1.0, r)
+        days = [{} for _ in range(horizon)]  # stability bin -> [weight, weight * difficulty] reviewed that day
+        states = {}  # (stability bin, 2 * difficulty) -> (interval, knowledge, cost, outcomes)
+
+        def state(key):
+            stability_bin, d2 = key
+            s = math.exp(stability_bin * WORKLOAD_STABILITY_STEP)
+            interval = min(max(round(s * c), 1), self.maximum_interval)
+            p = self.retrievability(interval, s)
+            knowledge = (2.0 * s / FACTOR) * (math.sqrt(1.0 + FACTOR * interval / s) - 1.0)
+            states[key] = (interval, knowledge, p * recall_cost + (1.0 - p) * forget_cost,
+                           self._workload_outcomes(s, d2 / 2.0, p))
+            return states[key]
+
+        def spread(day, outcomes, weight):
+            for stability_bin, share, d in outcomes:
+                w = weight * share
+                cell = day.get(stability_bin)
+                if cell is None:
+                    day[stability_bin] = [w, w * d]
+                else:
+                    cell[0] += w
+                    cell[1] += w * d
+
+        total_cost = 0.0
+        total_knowledge = 0.0
+        for bucket, count in buckets.items():
+            stability_bin, d2, elapsed_bin = bucket
+            elapsed = math.expm1(elapsed_bin / 2.0)
+            interval, _, cost, outcomes = states.get((stability_bin, d2)) or state((stability_bin, d2))
+            due = round(interval - elapsed)
+            if due <= 0:
+                # Overdue cards are reviewed straight away, at their current recall
+                if bucket not in overdue:
+                    s = math.exp(stability_bin * WORKLOAD_STABILITY_STEP)
+                    p = self.retrievability(elapsed, s)
+                    overdue[bucket] = (p * recall_cost + (1.0 - p) * forget_cost,
+                                       self._workload_outcomes(s, d2 / 2.0, p))
+                cost, outcomes = overdue[bucket]
+                due = 0
+            if due >= horizon:
+                continue
+            total_cost += count * cost
+            spread(days[due], outcomes, count)
+
+        for t in range(horizon):
+            for stability_bin, (weight, weighted_d) in days[t].items():
+                if weight < 1e-9:
+                    continue  # long chains of lapses thin out to nothing
+                key = (stability_bin, round(2.0 * weighted_d / weight))
+                interval, knowledge, cost, outcomes = states.get(key) or state(key)
+                total_knowledge += weight * knowledge
+                if t + interval >= horizon:
+                    continue
+                total_cost += weight * cost
+                day = days[t + interval]  # spread(), inlined: this loop dominates the run time
+                for next_bin, share, d in outcomes:
+                    w = weight * share
+                    cell = day.get(next_bin)
+                    if cell is None:
+                        day[next_bin] = [w, w * d]
+                    else:
+                        cell[0] += w
+                        cell[1] += w * d
+        return total_cost, total_knowledge
+
+    def _workload_outcomes(self, s, d, p):
+        # Success (as Good) and lapse branches as (stability bin, share, difficulty),
+        # each split between its two neighbouring bins
+        outcomes = []
+        for new_s, new_d, share in (
+            (self.next_stability_success(d, s, p, Rating.Good), self.next_difficulty(d, Rating.Good), p),
+            (self.next_stability_fail(d, s, p), self.next_difficulty(d, Rating.Again), 1.0 - p),
+        ):
+            x = math.log(new_s) / WORKLOAD_STABILITY_STEP
+            low = math.floor(x)
+            for stability_bin, bin_share in ((low, 1.0 - (x - low)), (low + 1, x - low)):
+                if share * bin_share > 0.0:
+                    outcomes.append((stability_bin, share * bin_share, new_d))
+        return outcomes
+
+    def get_queue(self, cards, today=None, limit=None, order="overdue", cursor=None):
         """Build review queue from a dict of {concept_id: card_dict}.
-        Returns {due: [...], upcoming: [...]}."""
+        Returns {due: [...], upcoming: [...], stats: {...}, next_cursor: ...}.
+
+        order: "overdue" (most overdue first), "retrievability" (lowest R first)
+        or "difficulty" (hardest first). Relearning cards always lead.
+        limit: cap on due cards returned; picked with a heap in O(n log k).
+        cursor: next_cursor from a previous call, to page through the rest."""
+        if order not in QUEUE_ORDERS:
+            raise ValueError(f"Unknown queue order: {order}")
+        if limit is not None and (isinstance(limit, bool) or not isinstance(limit, int) or limit < 1):
+            raise ValueError("limit must be an integer of at least 1")
+        after = self._parse_cursor(cursor, order) if cursor is not None else None
+        # Retrievability is evaluated at `today`, so rankings hold for any queue date
         if today is None:
-            today = datetime.now(timezone.utc).date()
+            as_of = datetime.now(timezone.utc)
         elif isinstance(today, str):
-            today = datetime.fromisoformat(today.replace("Z", "+00:00")).date()
+            as_of = datetime.fromisoformat(today.replace("Z", "+00:00"))
+            if as_of.tzinfo is None:
+                as_of = as_of.replace(tzinfo=timezone.utc)
+        else:
+            as_of = datetime(today.year, today.month, today.day, tzinfo=timezone.utc)
+        today = as_of.date()
 
         due = []
         upcoming = []
@@ -316,7 +701,7 @@ class FSRS:
 
             due_date = datetime.fromisoformat(card.due.replace("Z", "+00:00")).date()
             last_review = datetime.fromisoformat(card.last_review.replace("Z", "+00:00"))
-            elapsed = (datetime.now(timezone.utc) - last_review).days
+            elapsed = max(0, (as_of - last_review).days)
             r = self.retrievability(elapsed, card.stability) if card.stability > 0 else 0.0
             total_retrievability += r
             active_count += 1
@@ -339,8 +724,20 @@ class FSRS:
                     "stability": round(card.stability, 2),
                 })
 
-        # Sort: relearning first, then most overdue
-        due.sort(key=lambda x: (-1 if x["state"] == State.Relearning else 0, -x["overdue_days"]))
+        due_total = len(due)
+
+        # Keys are total (concept_id breaks ties), so a cursor is the order plus the last key served
+        key = lambda x: self._queue_key(x, order)
+        if after is not None:
+            due = [x for x in due if key(x) > after]
+
+        next_cursor = None
+        if limit is None or limit >= len(due):
+            due.sort(key=key)
+        else:
+            due = heapq.nsmallest(limit, due, key=key)
+            if due:
+                next_cursor = [order, *key(due[-1])]
         upcoming.sort(key=lambda x: x["due_date"])
 
         avg_r = round(total_retrievability / active_count, 4) if active_count > 0 else 0.0
@@ -350,12 +747,34 @@ class FSRS:
             "upcoming": upcoming,
             "stats": {
                 "total_active_cards": total_active,
-                "due_today": len(due),
-                "due_this_week": len(due) + len(upcoming),
+                "due_today": due_total,
+                "due_this_week": due_total + len(upcoming),
                 "average_retrievability": avg_r,
             },
+            "next_cursor": next_cursor,
         }
 
+    def _queue_key(self, item, order):
+        relearning = -1 if item["state"] == State.Relearning else 0
+        if order == "retrievability":
+            primary = item["retrievability"]
+        elif order == "difficulty":
+            primary = -item["difficulty"]
+        else:
+            primary = -item["overdue_days"]
+        return (relearning, primary, item["concept_id"])
+
+    def _parse_cursor(self, cursor, order):
+        if not isinstance(cursor, list) or len(cursor) != 4:
+            raise ValueError("cursor must be the next_cursor list from a previous queue call")
+        cursor_order, relearning, primary, concept_id = cursor
+        if cursor_order != order:
+            raise ValueError(f"cursor was issued for order {cursor_order!r}, not {order!r}")
+        numeric = all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in (relearning, primary))
+        if not numeric or not isinstance(concept_id, str):
+            raise ValueError("cursor must be the next_cursor list from a previous queue call")
+        return (relearning, primary, concept_id)
+
     # --- Helpers ---
 
     def _add_days(self, iso_date, days):
@@ -366,3 +785,19 @@ class FSRS:
         start = datetime.fromisoformat(iso_start.replace("Z", "+00:00"))
         end = datetime.fromisoformat(iso_end.replace("Z", "+00:00"))
         return max(0, (end - start).days)
+
+
+def reschedule_batch(items, parameters):
+    """Reschedule [(concept_id, card_dict, log_dicts), ...] under state.json
+    FSRS parameters, returning (concept_id, card_dict, log_dicts, replayed).
+    Module-level so batches can be sent to a process pool."""
+    fsrs = FSRS(
+        w=parameters.get("w"),
+        desired_retention=parameters.get("request_retention", 0.9),
+        maximum_interval=parameters.get("maximum_interval", 365),
+    )
+    results = []
+    for concept_id, card_data, logs in items:
+        card, new_logs, replayed = fsrs.reschedule(Card.from_dict(card_data), logs)
+        results.append((concept_id, card.to_dict(), new_logs, replayed))
+    return results
@@ -6,19 +6,33 @@ Called by Claude during sessions to compute review scheduling.
 Usage:
   python3 fsrs-helper.py review --card '{"state":0,...}' --rating 3
   python3 fsrs-helper.py queue --state .learning/state.json
+  python3 fsrs-helper.py queue --state .learning/state.json --limit 20 --order retrievability
   python3 fsrs-helper.py preview --card '{"state":2,...}'
+  python3 fsrs-helper.py reschedule --state .learning/state.json --workers 4
+  python3 fsrs-helper.py weak --state .learning/state.json --threshold 0.8 --by 2026-03-06
+  python3 fsrs-helper.py import-anki --state .learning/state.json --collection collection.anki2
+  python3 fsrs-helper.py tune-retention --state .learning/state.json
 """
 
 import argparse
+import html
+import itertools
 import json
+import math
 import os
+import pathlib
+import re
+import sqlite3
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 
 # Import from vendored core (same directory)
 import importlib.util
 _core_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fsrs-core.py")
 _spec = importlib.util.spec_from_file_location("fsrs_core", _core_path)
 _mod = importlib.util.module_from_spec(_spec)
+sys.modules["fsrs_core"] = _mod  # lets process-pool workers unpickle core functions
 _spec.loader.exec_module(_mod)
 FSRS = _mod.FSRS
 Card = _mod.Card
@@ -71,7 +85,14 @@ def cmd_queue(args):
         desired_retention=fsrs_params.get("request_retention", 0.9),
     )
 
-    queue = fsrs.get_queue(cards, args.date)
+    try:
+        cursor = json.loads(args.cursor) if args.cursor else None
+    except ValueError:
+        sys.exit("Error: --cursor is not valid JSON")
+    try:
+        queue = fsrs.get_queue(cards, args.date, limit=args.limit, order=args.order, cursor=cursor)
+    except ValueError as e:
+        sys.exit(f"Error: {e}")
     print(json.dumps(queue, indent=2))
 
 
@@ -93,6 +114,237 @@ def cmd_preview(args):
     print(json.dumps(result, indent=2))
 
 
+def cmd_reschedule(args):
+    """Recompute every card's schedule under the current state.json parameters.
+    Cards whose review_logs cover every review are replayed; other Review
+    cards get a closed-form interval from their stability. State is written once."""
+    with open(args.state, "r") as f:
+        state = json.load(f)
+
+    concepts = state.get("concepts", {})
+    fsrs_params = state.get("fsrs", {}).get("parameters", {})
+
+    items = []
+    for concept_id, concept in concepts.items():
+        fsrs_card = concept.get("fsrs_card")
+        if fsrs_card:
+            items.append((concept_id, fsrs_card, concept.get("review_logs")))
+
+    batches = [items[i:i + args.batch_size] for i in range(0, len(items), args.batch_size)]
+    if args.workers > 1 and len(batches) > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            results = pool.map(_mod.reschedule_batch, batches, [fsrs_params] * len(batches))
+            results = [r for batch in results for r in batch]
+    else:
+        results = [r for batch in batches for r in _mod.reschedule_batch(batch, fsrs_params)]
+
+    summary = {"replayed": 0, "recomputed": 0, "unchanged": 0, "stale_logs": []}
+    for concept_id, card, logs, replayed in results:
+        concept = concepts[concept_id]
+        old_card = concept["fsrs_card"]
+        if replayed:
+            summary["replayed"] += 1
+            concept["review_logs"] = logs
+        elif card["due"] != old_card.get("due") or card["scheduled_days"] != old_card.get("scheduled_days"):
+            summary["recomputed"] += 1
+        else:
+            summary["unchanged"] += 1
+        if logs and not replayed:
+            # Log doesn't cover the card's reviews; rescheduled from stability instead
+            summary["stale_logs"].append(concept_id)
+        concept["fsrs_card"] = card
+        if "fsrs" in concept:
+            concept["fsrs"] = card  # session-close keeps both field names
+
+    tmp_path = args.state + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+        f.write("\n")
+    os.replace(tmp_path, args.state)
+
+    print(json.dumps(summary, indent=2))
+
+
+def cmd_weak(args):
+    """List concepts below a retrievability threshold by a date, or the weakest now."""
+    with open(args.state, "r") as f:
+        state = json.load(f)
+
+    concepts = state.get("concepts", {})
+    fsrs_params = state.get("fsrs", {}).get("parameters", {})
+
+    cards = {}
+    for concept_id, concept in concepts.items():
+        fsrs_card = concept.get("fsrs_card")
+        if fsrs_card:
+            cards[concept_id] = fsrs_card
+
+    fsrs = FSRS(
+        w=fsrs_params.get("w"),
+        desired_retention=fsrs_params.get("request_retention", 0.9),
+    )
+
+    index = _mod.RetrievabilityIndex(fsrs, cards)
+    if args.threshold is not None:
+        weak = index.below(args.threshold, args.by)
+        if args.limit is not None:
+            weak = weak[:args.limit]
+    else:
+        weak = index.weakest(20 if args.limit is None else args.limit, args.by)
+
+    print(json.dumps({"weak": weak, "indexed_cards": len(index)}, indent=2))
+
+
+# Graded reviews (learn, review, relearn, filtered) plus "Forget" resets,
+# streamed one card at a time in review order.
+ANKI_REVLOG_QUERY = """
+    SELECT r.cid, r.id, r.ease, r.type, n.sfld
+    FROM revlog r
+    JOIN cards c ON c.id = r.cid
+    JOIN notes n ON n.id = c.nid
+    WHERE ((r.ease BETWEEN 1 AND 4 AND r.type IN (0, 1, 2, 3))
+           OR (r.type = 4 AND r.ivl = 0))
+      {deck_filter}
+    ORDER BY r.cid, r.id
+"""
+
+
+def _anki_text(field):
+    """Plain text of an Anki sort field: sfld has integer affinity, so numeric
+    fields come back as int, and it keeps the note's HTML."""
+    if field is None:
+        return ""
+    text = html.unescape(re.sub(r"<[^>]*>", " ", str(field)))
+    return " ".join(text.split())
+
+
+def cmd_import_anki(args):
+    """Seed FSRS cards from an Anki collection's review history."""
+    with open(args.state, "r") as f:
+        state = json.load(f)
+
+    concepts = state.setdefault("concepts", {})
+    fsrs_params = state.get("fsrs", {}).get("parameters", {})
+
+    fsrs = FSRS(
+        w=fsrs_params.get("w"),
+        desired_retention=fsrs_params.get("request_retention", 0.9),
+        maximum_interval=fsrs_params.get("maximum_interval", 365),
+    )
+
+    # as_uri() percent-encodes "?", "#" and "%" in the path, which a raw file: URI would misread
+    conn = sqlite3.connect(pathlib.Path(args.collection).resolve().as_uri() + "?mode=ro", uri=True)
+    try:
+        query = ANKI_REVLOG_QUERY.format(deck_filter="AND c.did = ?" if args.deck else "")
+        rows = conn.execute(query, (args.deck,) if args.deck else ())
+
+        summary = {"imported": 0, "skipped_existing": 0, "reviews": 0}
+        for cid, card_rows in itertools.groupby(rows, key=lambda row: row[0]):
+            concept_id = f"anki-{cid}"
+            if concept_id in concepts and not args.overwrite:
+                summary["skipped_existing"] += 1
+                continue
+
+            card = Card()
+            logs = []
+            name = None
+            for _, revlog_id, ease, revlog_type, sort_field in card_rows:
+                name = sort_field
+                if revlog_type == 4:
+                    # Card was reset to new in Anki; earlier history no longer applies
+                    card = Card()
+                    logs = []
+                    continue
+                review_date = datetime.fromtimestamp(revlog_id / 1000.0, timezone.utc).isoformat()
+                card, log = fsrs.review(card, ease, review_date)
+                logs.append(log.to_dict())
+            if not logs:
+                continue
+
+            concept = concepts.setdefault(concept_id, {
+                "name": _anki_text(name)[:120],
+                "prerequisites": [],
+                "bloom_level": 0,
+                "misconceptions": [],
+                "source": "anki",
+            })
+            concept["mastery_state"] = "learning"
+            concept["fsrs_card"] = card.to_dict()
+            if "fsrs" in concept:
+                concept["fsrs"] = concept["fsrs_card"]  # session-close reads this name first
+            if not args.skip_logs:
+                concept["review_logs"] = logs
+            else:
+                concept.pop("review_logs", None)  # an overwritten card's old logs no longer match it
+            summary["imported"] += 1
+            summary["reviews"] += len(logs)
+    finally:
+        conn.close()
+
+    tmp_path = args.state + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+        f.write("\n")
+    os.replace(tmp_path, args.state)
+
+    print(json.dumps(summary, indent=2))
+
+
+def cmd_tune_retention(args):
+    """Recommend the desired retention that minimizes workload per memorized card."""
+    with open(args.state, "r") as f:
+        state = json.load(f)
+
+    concepts = state.get("concepts", {})
+    fsrs_params = state.get("fsrs", {}).get("parameters", {})
+
+    cards = {}
+    for concept_id, concept in concepts.items():
+        fsrs_card = concept.get("fsrs_card")
+        if fsrs_card:
+            cards[concept_id] = fsrs_card
+
+    fsrs = FSRS(
+        w=fsrs_params.get("w"),
+        desired_retention=fsrs_params.get("request_retention", 0.9),
+        maximum_interval=fsrs_params.get("maximum_interval", 365),
+    )
+
+    steps = math.floor((args.max - args.min) / args.step + 1e-9)
+    retentions = [round(args.min + i * args.step, 4) for i in range(steps + 1)]
+    # The current setting is scored in the same pass, so the deck is bucketed once
+    current = fsrs.desired_retention
+    scored_retentions = retentions if current in retentions else retentions + [current]
+    workload = fsrs.retention_workload(
+        cards, scored_retentions, args.horizon, args.recall_cost, args.forget_cost, today=args.date
+    )
+    grid = workload[:len(retentions)]
+    baseline = next(g for g in workload if g["retention"] == current)
+
+    scored = [g for g in grid if g["cost_per_memorized"] is not None]
+    if not scored or baseline["cost_per_memorized"] is None:
+        print(json.dumps({"recommended_retention": None, "current_retention": current,
+                          "reason": "no reviewed cards to model", "grid": grid}, indent=2))
+        return
+
+    best = min(scored, key=lambda g: g["cost_per_memorized"])
+    if best["retention"] == retentions[0] and len(retentions) > 1:
+        reason = "lowest workload at --min; the model may favour an even lower target"
+    elif best["retention"] == retentions[-1] and len(retentions) > 1:
+        reason = "lowest workload at --max; the model may favour an even higher target"
+    else:
+        reason = "lowest workload per memorized card"
+
+    result = {
+        "recommended_retention": best["retention"],
+        "current_retention": current,
+        "expected_saving": round(1.0 - best["cost_per_memorized"] / baseline["cost_per_memorized"], 4),
+        "reason": reason,
+        "grid": grid,
+    }
+    print(json.dumps(result, indent=2))
+
+
 def main():
     parser = argparse.ArgumentParser(description="FSRS-5 helper for Synapse")
     subparsers = parser.add_subparsers(dest="command", required=True)
@@ -108,6 +360,10 @@ def main():
     p_queue = subparsers.add_parser("queue", help="Get today's review queue")
     p_queue.add_argument("--state", required=True, help="Path to state.json")
     p_queue.add_argument("--date", default=None, help="Today's date (ISO format)")
+    p_queue.add_argument("--limit", default=None, type=int, help="Max due cards to return")
+    p_queue.add_argument("--order", default="overdue", choices=list(_mod.QUEUE_ORDERS),
+                         help="Priority for due cards (relearning always first)")
+    p_queue.add_argument("--cursor", default=None, help="next_cursor from a previous page (JSON)")
 
     # preview command
     p_preview = subparsers.add_parser("preview", help="Preview all rating outcomes")
@@ -115,14 +371,75 @@ def main():
     p_preview.add_argument("--date", default=None, help="Review date (ISO format)")
     p_preview.add_argument("--params", default=None, help="FSRS parameters as JSON")
 
+    # reschedule command
+    p_reschedule = subparsers.add_parser("reschedule", help="Recompute all cards under current parameters")
+    p_reschedule.add_argument("--state", required=True, help="Path to state.json")
+    p_reschedule.add_argument("--workers", default=1, type=int, help="Process pool size")
+    p_reschedule.add_argument("--batch-size", default=2000, type=int, help="Cards per batch")
+
+    # weak command
+    p_weak = subparsers.add_parser("weak", help="Concepts below a retrievability threshold")
+    p_weak.add_argument("--state", required=True, help="Path to state.json")
+    p_weak.add_argument("--threshold", default=None, type=float,
+                        help="Retrievability cutoff (omit for the weakest cards)")
+    p_weak.add_argument("--by", default=None, help="Date to evaluate at (ISO format, default now)")
+    p_weak.add_argument("--limit", default=None, type=int, help="Max concepts to return")
+
+    # import-anki command
+    p_anki = subparsers.add_parser("import-anki", help="Seed cards from an Anki collection's review history")
+    p_anki.add_argument("--state", required=True, help="Path to state.json")
+    p_anki.add_argument("--collection", required=True, help="Path to collection.anki2 (close Anki first)")
+    p_anki.add_argument("--deck", default=None, type=int, help="Only import cards from this deck id")
+    p_anki.add_argument("--overwrite", action="store_true", help="Replace concepts imported earlier")
+    p_anki.add_argument("--skip-logs", action="store_true", help="Do not store review_logs per concept")
+
+    # tune-retention command
+    p_tune = subparsers.add_parser("tune-retention", help="Recommend a workload-minimizing desired retention")
+    p_tune.add_argument("--state", required=True, help="Path to state.json")
+    p_tune.add_argument("--min", default=0.70, type=float, help="Lowest retention to consider")
+    p_tune.add_argument("--max", default=0.97, type=float, help="Highest retention to consider")
+    p_tune.add_argument("--step", default=0.01, type=float, help="Grid step")
+    p_tune.add_argument("--horizon", default=365, type=int, help="Days to model")
+    p_tune.add_argument("--date", default=None, help="Date to model from (ISO format, default now)")
+    p_tune.add_argument("--recall-cost", default=7.0, type=float, help="Seconds per successful review")
+    p_tune.add_argument("--forget-cost", default=23.0, type=float, help="Seconds per lapse, incl. relearning")
+
     args = parser.parse_args()
 
+    if args.command == "queue" and args.limit is not None and args.limit < 1:
+        p_queue.error("--limit must be at least 1")
+    if args.command == "reschedule":
+        if args.workers < 1:
+            p_reschedule.error("--workers must be at least 1")
+        if args.batch_size < 1:
+            p_reschedule.error("--batch-size must be at least 1")
+    if args.command == "weak":
+        if args.threshold is not None and not 0 < args.threshold < 1:
+            p_weak.error("--threshold must be between 0 and 1 (exclusive)")
+        if args.limit is not None and args.limit < 1:
+            p_weak.error("--limit must be at least 1")
+    if args.command == "tune-retention":
+        if not 0 < args.min <= args.max < 1:
+            p_tune.error("need 0 < --min <= --max < 1")
+        if args.step <= 0:
+            p_tune.error("--step must be positive")
+        if args.horizon < 1:
+            p_tune.error("--horizon must be at least 1 day")
+
     if args.command == "review":
         cmd_review(args)
     elif args.command == "queue":
         cmd_queue(args)
     elif args.command == "preview":
         cmd_preview(args)
+    elif args.command == "reschedule":
+        cmd_reschedule(args)
+    elif args.command == "weak":
+        cmd_weak(args)
+    elif args.command == "import-anki":
+        cmd_import_anki(args)
+    elif args.command == "tune-retention":
+        cmd_tune_retention(args)
 
 
 if __name__ == "__main__":
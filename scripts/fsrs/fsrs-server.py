@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+"""
+FSRS Server — long-lived local FSRS service for many learner directories.
+Serves the same operations as fsrs-helper.py without a process per call.
+
+Usage:
+  python3 fsrs-server.py --root /srv/learners --port 8765
+  python3 fsrs-server.py --root /srv/learners --socket /run/synapse-fsrs.sock
+
+Every endpoint takes a POST with a JSON body naming the learner directory
+(relative to --root; its state lives in <learner>/.learning/state.json):
+  POST /review   {"learner": "ana", "concept_id": "...", "rating": 3, "date": null}
+  POST /queue    {"learner": "ana", "date": null, "limit": 20, "order": "overdue", "cursor": null}
+  POST /preview  {"learner": "ana", "concept_id": "...", "date": null}
+  POST /stats    {"learner": "ana"}
+  POST /weak     {"learner": "ana", "threshold": 0.8, "by": "2026-03-06", "limit": 20}
+
+In-session learning steps (minute-level re-shows, see ShortTermSession):
+  POST /session/start   {"learner": "ana", "concept_ids": ["..."], "learning_steps": [1, 10]}
+  POST /session/next    {"session_id": "...", "now": null}
+  POST /session/answer  {"session_id": "...", "concept_id": "...", "rating": 1, "date": null}
+  POST /session/end     {"session_id": "..."}
+Answers are saved to the learner's state like /review, and each answer
+starts from the card as currently stored, so a /review made meanwhile is
+kept. Sessions live in memory until ended or idle for --session-ttl seconds.
+
+Parsed state files are kept in an LRU cache and re-read when their mtime
+changes. Reviews update the cached state and are written back per learner
+after --flush-delay ms, so a burst of reviews costs one write. While a
+learner has unflushed reviews the cache is authoritative: do not run
+session-close.js against the same learner while the server is writing it.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Import from vendored core (same directory)
+import importlib.util
+_core_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fsrs-core.py")
+_spec = importlib.util.spec_from_file_location("fsrs_core", _core_path)
+_mod = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(_mod)
+FSRS = _mod.FSRS
+Card = _mod.Card
+
+STATUS_TEXT = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+    413: "Payload Too Large", 500: "Internal Server Error",
+}
+MAX_BODY_BYTES = 1 << 20
+MAX_SESSIONS = 10000
+
+
+class RequestError(Exception):
+    """Client error, reported with an HTTP status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class LearnerEntry:
+    """Cached, parsed state.json for one learner."""
+
+    def __init__(self, path, state, mtime_ns):
+        self.path = path
+        self.state = state
+        self.mtime_ns = mtime_ns
+        self.fsrs = self._make_fsrs(state)
+        self.index = None  # RetrievabilityIndex, built on first /weak and dropped on review
+        self.dirty = False
+        self.flush_scheduled = False
+        self.lock = asyncio.Lock()
+
+    def _make_fsrs(self, state):
+        fsrs_params = state.get("fsrs", {}).get("parameters", {})
+        return FSRS(
+            w=fsrs_params.get("w"),
+            desired_retention=fsrs_params.get("request_retention", 0.9),
+            maximum_interval=fsrs_params.get("maximum_interval", 365),
+        )
+
+
+def _read_state(path):
+    with open(path, "r") as f:
+        mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+        return json.load(f), mtime_ns
+
+
+def _write_state(path, state):
+    data = json.dumps(state, indent=2) + "\n"
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return os.stat(path).st_mtime_ns
+
+
+class StateCache:
+    """LRU cache of learner states with mtime invalidation and coalesced writes."""
+
+    def __init__(self, root, max_size, flush_delay, executor, session_ttl=1800.0):
+        self.root = os.path.realpath(root)
+        self.max_size = max_size
+        self.flush_delay = flush_delay
+        self.executor = executor
+        self.session_ttl = session_ttl
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._sessions = OrderedDict()  # session_id -> [learner, ShortTermSession, last_used], oldest use first
+
+    def state_path(self, learner):
+        if not isinstance(learner, str) or not learner:
+            raise RequestError(400, "learner is required")
+        learner_dir = os.path.realpath(os.path.join(self.root, learner))
+        if not learner_dir.startswith(self.root + os.sep):
+            raise RequestError(400, f"learner outside root: {learner}")
+        return os.path.join(learner_dir, ".learning", "state.json")
+
+    async def get(self, learner):
+        path = self.state_path(learner)
+        entry = self._entries.get(path)
+        if entry is not None:
+            fresh = entry.dirty
+            if not fresh:
+                loop = asyncio.get_running_loop()
+                mtime_ns = await loop.run_in_executor(self.executor, self._mtime, path)
+                fresh = entry.dirty or mtime_ns == entry.mtime_ns
+            # The entry may have been evicted or replaced while the stat ran
+            if fresh and self._entries.get(path) is entry:
+                self._entries.move_to_end(path)
+                return entry
+        # One load per path, however many requests arrive while it is in flight
+        if path not in self._loading:
+            self._loading[path] = asyncio.ensure_future(self._load(path))
+        try:
+            return await asyncio.shield(self._loading[path])
+        finally:
+            self._loading.pop(path, None)
+
+    async def _load(self, path):
+        loop = asyncio.get_running_loop()
+        try:
+            state, mtime_ns = await loop.run_in_executor(self.executor, _read_state, path)
+        except FileNotFoundError:
+            raise RequestError(404, "No Synapse project found for learner")
+        entry = LearnerEntry(path, state, mtime_ns)
+        self._entries[path] = entry
+        self._entries.move_to_end(path)
+        self._evict()
+        return entry
+
+    def _evict(self):
+        # Learners with unflushed or in-flight reviews stay until they settle
+        for path in list(self._entries):
+            if len(self._entries) <= self.max_size:
+                break
+            entry = self._entries[path]
+            if not entry.dirty and not entry.lock.locked():
+                del self._entries[path]
+
+    def add_session(self, learner, session):
+        session_id = uuid.uuid4().hex
+        self._sessions[session_id] = [learner, session, asyncio.get_running_loop().time()]
+        self._expire_sessions()
+        return session_id
+
+    def session(self, session_id):
+        """(learner, ShortTermSession) for a live session; using it renews its TTL."""
+        self._expire_sessions()
+        record = self._sessions.get(session_id)
+        if record is None:
+            raise RequestError(404, f"session not found: {session_id}")
+        record[2] = asyncio.get_running_loop().time()
+        self._sessions.move_to_end(session_id)
+        return record[0], record[1]
+
+    def end_session(self, session_id):
+        _, session = self.session(session_id)
+        del self._sessions[session_id]
+        return session
+
+    def _expire_sessions(self):
+        cutoff = asyncio.get_running_loop().time() - self.session_ttl
+        while self._sessions:
+            session_id, record = next(iter(self._sessions.items()))
+            if record[2] > cutoff and len(self._sessions) <= MAX_SESSIONS:
+                break
+            del self._sessions[session_id]
+
+    def _mtime(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def mark_dirty(self, entry):
+        entry.dirty = True
+        if not entry.flush_scheduled:
+            entry.flush_scheduled = True
+            loop = asyncio.get_running_loop()
+            loop.call_later(self.flush_delay, lambda: asyncio.ensure_future(self.flush(entry)))
+
+    async def flush(self, entry):
+        async with entry.lock:
+            entry.flush_scheduled = False
+            if not entry.dirty:
+                return
+            # State is only mutated under entry.lock, so holding it lets the executor
+            # serialize without a copy and without stalling other learners
+            entry.dirty = False
+            loop = asyncio.get_running_loop()
+            try:
+                entry.mtime_ns = await loop.run_in_executor(self.executor, _write_state, entry.path, entry.state)
+            except OSError as e:
+                entry.dirty = True
+                print(f"Warning: could not write {entry.path}: {e}", file=sys.stderr)
+        self._evict()
+
+    async def flush_all(self):
+        await asyncio.gather(*(self.flush(e) for e in list(self._entries.values()) if e.dirty))
+
+
+def _cards(state):
+    cards = {}
+    for concept_id, concept in state.get("concepts", {}).items():
+        fsrs_card = concept.get("fsrs_card")
+        if fsrs_card:
+            cards[concept_id] = fsrs_card
+    return cards
+
+
+def _concept(entry, body):
+    concept_id = body.get("concept_id")
+    concept = entry.state.get("concepts", {}).get(concept_id)
+    if concept is None:
+        raise RequestError(404, f"concept not found: {concept_id}")
+    return concept_id, concept
+
+
+def _rating(body):
+    rating = body.get("rating")
+    if rating not in (1, 2, 3, 4):
+        raise RequestError(400, "rating must be 1-4")
+    return rating
+
+
+def _record_review(entry, concept, card, log):
+    concept["fsrs_card"] = card.to_dict()
+    if "fsrs" in concept:
+        concept["fsrs"] = concept["fsrs_card"]  # session-close keeps both field names
+    concept.setdefault("review_logs", []).append(log.to_dict())
+    entry.index = None
+
+
+async def handle_review(cache, body):
+    rating = _rating(body)
+    entry = await cache.get(body.get("learner"))
+    async with entry.lock:
+        _, concept = _concept(entry, body)
+        card = Card.from_dict(concept.get("fsrs_card") or {})
+        new_card, log = entry.fsrs.review(card, rating, body.get("date"))
+        _record_review(entry, concept, new_card, log)
+    cache.mark_dirty(entry)
+    return {"card": new_card.to_dict(), "log": log.to_dict(), "next_due": new_card.due}
+
+
+async def handle_queue(cache, body):
+    entry = await cache.get(body.get("learner"))
+    return entry.fsrs.get_queue(
+        _cards(entry.state),
+        body.get("date"),
+        limit=body.get("limit"),
+        order=body.get("order") or "overdue",
+        cursor=body.get("cursor"),
+    )
+
+
+async def handle_preview(cache, body):
+    entry = await cache.get(body.get("learner"))
+    _, concept = _concept(entry, body)
+    card = Card.from_dict(concept.get("fsrs_card") or {})
+    return entry.fsrs.preview(card, body.get("date"))
+
+
+async def handle_stats(cache, body):
+    entry = await cache.get(body.get("learner"))
+    return entry.fsrs.get_queue(_cards(entry.state), body.get("date"))["stats"]
+
+
+async def handle_weak(cache, body):
+    entry = await cache.get(body.get("learner"))
+    if entry.index is None:
+        entry.index = _mod.RetrievabilityIndex(entry.fsrs, _cards(entry.state))
+    limit = body.get("limit")
+    if limit is not None and (isinstance(limit, bool) or not isinstance(limit, int) or limit < 1):
+        raise RequestError(400, "limit must be an integer of at least 1")
+    threshold = body.get("threshold")
+    if threshold is not None:
+        weak = entry.index.below(threshold, body.get("by"))
+        if limit is not None:
+            weak = weak[:limit]
+    else:
+        weak = entry.index.weakest(20 if limit is None else limit, body.get("by"))
+    return {"weak": weak, "indexed_cards": len(entry.index)}
+
+
+async def handle_session_start(cache, body):
+    learner = body.get("learner")
+    concept_ids = body.get("concept_ids")
+    if not isinstance(concept_ids, list) or not concept_ids:
+        raise RequestError(400, "concept_ids must be a non-empty list")
+    entry = await cache.get(learner)
+    session = _mod.ShortTermSession(
+        entry.fsrs,
+        learning_steps=body.get("learning_steps") or (1, 10),
+        relearning_steps=body.get("relearning_steps") or (10,),
+    )
+    for concept_id in concept_ids:
+        _, concept = _concept(entry, {"concept_id": concept_id})
+        session.add(concept_id, concept.get("fsrs_card") or {}, body.get("date"))
+    session_id = cache.add_session(learner, session)
+    return {"session_id": session_id, "queued": len(session)}
+
+
+async def handle_session_next(cache, body):
+    learner, session = cache.session(body.get("session_id"))
+    taken = session.next(body.get("now"))
+    if taken is None:
+        # Nothing due yet: report when the next card comes back, if any
+        waiting = session.peek()
+        return {"concept_id": None, "next_show_at": waiting[1] if waiting else None, "queued": len(session)}
+    concept_id, _, show_at = taken
+    # The stored card, not the session's copy, in case it was reviewed meanwhile
+    entry = await cache.get(learner)
+    _, concept = _concept(entry, {"concept_id": concept_id})
+    card = Card.from_dict(concept.get("fsrs_card") or {})
+    return {"concept_id": concept_id, "card": card.to_dict(), "show_at": show_at, "queued": len(session)}
+
+
+async def handle_session_answer(cache, body):
+    rating = _rating(body)
+    learner, session = cache.session(body.get("session_id"))
+    entry = await cache.get(learner)
+    async with entry.lock:
+        concept_id, concept = _concept(entry, body)
+        stored = Card.from_dict(concept.get("fsrs_card") or {})
+        card, log, show_at = session.answer(concept_id, rating, body.get("date"), card=stored)
+        _record_review(entry, concept, card, log)
+    cache.mark_dirty(entry)
+    return {"card": card.to_dict(), "log": log.to_dict(), "show_at": show_at, "queued": len(session)}
+
+
+async def handle_session_end(cache, body):
+    session = cache.end_session(body.get("session_id"))
+    return {"ended": True, "unfinished": len(session)}
+
+
+ROUTES = {
+    "/review": handle_review,
+    "/queue": handle_queue,
+    "/preview": handle_preview,
+    "/stats": handle_stats,
+    "/weak": handle_weak,
+    "/session/start": handle_session_start,
+    "/session/next": handle_session_next,
+    "/session/answer": handle_session_answer,
+    "/session/end": handle_session_end,
+}
+
+
+async def _dispatch(cache, method, path, raw_body):
+    if path not in ROUTES:
+        raise RequestError(404, f"unknown endpoint: {path}")
+    if method != "POST":
+        raise RequestError(405, "use POST with a JSON body")
+    try:
+        body = json.loads(raw_body or b"{}")
+    except ValueError:
+        raise RequestError(400, "body is not valid JSON")
+    if not isinstance(body, dict):
+        raise RequestError(400, "body must be a JSON object")
+    try:
+        return await ROUTES[path](cache, body)
+    except (ValueError, TypeError) as e:
+        raise RequestError(400, str(e))
+
+
+def _respond(writer, status, result, keep_alive):
+    payload = json.dumps(result).encode()
+    writer.write(
+        f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+        f"Content-Type: application/json\r\n"
+        f"Content-Length: {len(payload)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + payload
+    )
+
+
+async def _read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            return headers
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+async def handle_connection(cache, reader, writer):
+    try:
+        while True:
+            try:
+                request_line = await reader.readline()
+            except ValueError:  # longer than the stream limit
+                _respond(writer, 400, {"error": "request line too long"}, False)
+                break
+            if not request_line:
+                break
+            try:
+                method, target, version = request_line.decode("latin-1").split()
+            except ValueError:
+                _respond(writer, 400, {"error": "malformed request line"}, False)
+                break
+
+            try:
+                headers = await _read_headers(reader)
+            except ValueError:
+                _respond(writer, 400, {"error": "header line too long"}, False)
+                break
+
+            # Without a usable length the body can't be framed, so the connection ends here
+            try:
+                length = int(headers.get("content-length", 0))
+            except ValueError:
+                length = -1
+            if length < 0:
+                _respond(writer, 400, {"error": "invalid Content-Length"}, False)
+                break
+            if length > MAX_BODY_BYTES:
+                _respond(writer, 413, {"error": f"body larger than {MAX_BODY_BYTES} bytes"}, False)
+                break
+            raw_body = await reader.readexactly(length)
+
+            try:
+                status, result = 200, await _dispatch(cache, method, target.split("?", 1)[0], raw_body)
+            except RequestError as e:
+                status, result = e.status, {"error": str(e)}
+            except Exception as e:
+                status, result = 500, {"error": f"{type(e).__name__}: {e}"}
+
+            keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+            _respond(writer, status, result, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(args):
+    executor = ThreadPoolExecutor(max_workers=args.io_threads)
+    cache = StateCache(args.root, args.cache_size, args.flush_delay / 1000.0, executor, args.session_ttl)
+    connections = {}  # handler task -> writer, so shutdown can close idle keep-alive clients
+
+    async def client(reader, writer):
+        task = asyncio.current_task()
+        connections[task] = writer
+        try:
+            await handle_connection(cache, reader, writer)
+        finally:
+            connections.pop(task, None)
+
+    if args.socket:
+        server = await asyncio.start_unix_server(client, path=args.socket)
+        where = args.socket
+    else:
+        server = await asyncio.start_server(client, host=args.host, port=args.port)
+        where = f"{args.host}:{args.port}"
+    print(f"FSRS server listening on {where}", file=sys.stderr)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await stop.wait()
+    # Stop accepting, drop open connections (idle keep-alive clients would
+    # otherwise hold wait_closed() open on 3.12+), then persist pending reviews
+    server.close()
+    for writer in list(connections.values()):
+        writer.close()
+    if connections:
+        await asyncio.wait(list(connections), timeout=5)
+    await cache.flush_all()
+    await server.wait_closed()
+    executor.shutdown()
+    if args.socket:
+        os.unlink(args.socket)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Long-lived FSRS-5 service for Synapse")
+    parser.add_argument("--root", required=True, help="Directory containing learner directories")
+    parser.add_argument("--host", default="127.0.0.1", help="TCP host")
+    parser.add_argument("--port", default=8765, type=int, help="TCP port")
+    parser.add_argument("--socket", default=None, help="Unix socket path (instead of TCP)")
+    parser.add_argument("--cache-size", default=8192, type=int, help="Max learner states kept parsed")
+    parser.add_argument("--flush-delay", default=200, type=int, help="Write coalescing window in ms")
+    parser.add_argument("--io-threads", default=8, type=int, help="Threads for file I/O")
+    parser.add_argument("--session-ttl", default=1800, type=int, help="Seconds before an idle session is dropped")
+
+    args = parser.parse_args()
+    if args.session_ttl < 1:
+        parser.error("--session-ttl must be at least 1 second")
+    asyncio.run(serve(args))
+
+
+if __name__ == "__main__":
+    main()